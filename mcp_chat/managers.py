@@ -1,61 +1,120 @@
 """In-memory storage managers for chat rooms."""
 
-from typing import Dict, Optional
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
 import asyncio
 
 from mcp_chat.models import User, ChatRoom
 
+# Number of recently closed rooms kept so late callers get "Chat has ended"
+CLOSED_ROOM_CACHE_SIZE = 1000
+
+# Number of lock shards; must be a power of two so the hash can be masked
+LOCK_SHARDS = 64
+
 
 class RoomManager:
     """Manages active chat rooms."""
 
     def __init__(self) -> None:
         self._rooms: Dict[str, ChatRoom] = {}
+        # Recently closed rooms (room_id -> (user1_id, user2_id))
+        self._closed_rooms: OrderedDict[str, Tuple[str, str]] = OrderedDict()
         self._user_to_room: Dict[str, str] = {}
-        self._lock = asyncio.Lock()
+        # User IDs currently in each room (room_id -> [user_id, ...])
+        self._room_members: Dict[str, List[str]] = {}
+        # Writes are locked by shard so unrelated rooms don't block each other.
+        # Reads are single dict lookups and never yield, so they skip the lock.
+        self._locks: List[asyncio.Lock] = [asyncio.Lock() for _ in range(LOCK_SHARDS)]
+
+    def _lock_for(self, room_id: str) -> asyncio.Lock:
+        """Get the lock guarding the shard a room belongs to."""
+        return self._locks[hash(room_id) & (LOCK_SHARDS - 1)]
 
     async def create_room(self, user1: User, user2: User) -> ChatRoom:
         """Create a new chat room for two users."""
-        async with self._lock:
-            room = ChatRoom(user1=user1, user2=user2)
+        room = ChatRoom(user1=user1, user2=user2)
+        async with self._lock_for(room.room_id):
             self._rooms[room.room_id] = room
             self._user_to_room[user1.user_id] = room.room_id
             self._user_to_room[user2.user_id] = room.room_id
+            self._room_members[room.room_id] = [user1.user_id, user2.user_id]
             return room
 
-    async def get_room(self, room_id: str) -> Optional[ChatRoom]:
-        """Get a room by ID."""
-        async with self._lock:
-            return self._rooms.get(room_id)
+    async def register_single_user_room(
+        self, room_id: str, user: User
+    ) -> Optional[ChatRoom]:
+        """Create a room with a caller-chosen ID holding a single user.
+
+        The user fills both slots until a second user joins. Returns None
+        if a room with this ID already exists or was recently closed.
+        """
+        async with self._lock_for(room_id):
+            if room_id in self._rooms or room_id in self._closed_rooms:
+                return None
+            room = ChatRoom(room_id=room_id, user1=user, user2=user)
+            self._rooms[room_id] = room
+            self._user_to_room[user.user_id] = room_id
+            self._room_members[room_id] = [user.user_id]
+            return room
+
+    async def add_second_user(self, room_id: str, user: User) -> bool:
+        """Add a second user to a single-user room.
 
-    async def get_user_room(self, user_id: str) -> Optional[ChatRoom]:
+        Returns False if the room no longer exists or is already full.
+        """
+        async with self._lock_for(room_id):
+            room = self._rooms.get(room_id)
+            members = self._room_members.get(room_id)
+            if not room or not members or len(members) >= 2:
+                return False
+            room.user2 = user
+            self._user_to_room[user.user_id] = room_id
+            members.append(user.user_id)
+            return True
+
+    def get_room(self, room_id: str) -> Optional[ChatRoom]:
+        """Get an open room by ID."""
+        return self._rooms.get(room_id)
+
+    def get_closed_room_users(self, room_id: str) -> Optional[Tuple[str, str]]:
+        """Get the two user IDs of a recently closed room, if it was one."""
+        return self._closed_rooms.get(room_id)
+
+    def get_user_room(self, user_id: str) -> Optional[ChatRoom]:
         """Get the room a user is currently in."""
-        async with self._lock:
-            room_id = self._user_to_room.get(user_id)
-            if room_id:
-                return self._rooms.get(room_id)
-            return None
+        room_id = self._user_to_room.get(user_id)
+        if room_id:
+            return self._rooms.get(room_id)
+        return None
 
     async def close_room(self, room_id: str) -> Optional[ChatRoom]:
         """Close a room and remove users from it."""
-        async with self._lock:
-            room = self._rooms.get(room_id)
-            if room:
-                room.active = False
-                # Remove users from mapping
-                self._user_to_room.pop(room.user1.user_id, None)
-                self._user_to_room.pop(room.user2.user_id, None)
-                # Keep room in history for now (could implement cleanup later)
+        async with self._lock_for(room_id):
+            room = self._rooms.pop(room_id, None)
+            if not room:
+                return None
+
+            room.active = False
+            # Nobody can wait in a closed room, so buffered messages are unread
+            room.user1_pending = room.user2_pending = None
+            # Remove users from mapping
+            self._user_to_room.pop(room.user1.user_id, None)
+            self._user_to_room.pop(room.user2.user_id, None)
+            self._room_members.pop(room_id, None)
+            # Remember only who was in the room, for a bounded number of rooms
+            self._closed_rooms[room_id] = (room.user1.user_id, room.user2.user_id)
+            if len(self._closed_rooms) > CLOSED_ROOM_CACHE_SIZE:
+                self._closed_rooms.popitem(last=False)
             return room
 
     async def remove_user(self, user_id: str) -> Optional[ChatRoom]:
         """Remove a user from their room and close it."""
-        room = await self.get_user_room(user_id)
+        room = self.get_user_room(user_id)
         if room:
             await self.close_room(room.room_id)
         return room
 
-    async def get_active_room_count(self) -> int:
+    def get_active_room_count(self) -> int:
         """Get the number of active rooms."""
-        async with self._lock:
-            return sum(1 for room in self._rooms.values() if room.active)
+        return len(self._rooms)
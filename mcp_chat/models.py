@@ -2,34 +2,59 @@
 
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Optional
-import uuid
+from typing import Any, Deque, Dict, Optional
+import asyncio
+import secrets
 
 
-@dataclass
+def generate_id() -> str:
+    """Generate a unique identifier.
+
+    The 128 random bits match a UUID4 without building and formatting a
+    UUID object.
+    """
+    return secrets.token_hex(16)
+
+
+@dataclass(slots=True, eq=False)
 class User:
     """Represents a connected user."""
 
-    user_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    user_id: str = field(default_factory=generate_id)
     display_name: Optional[str] = None
     connection_id: str = ""  # SSE connection identifier
     joined_at: datetime = field(default_factory=datetime.now)
+    _name: str = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._name = self.display_name or f"Anonymous-{self.user_id[:8]}"
 
     @property
     def name(self) -> str:
         """Get display name or anonymous identifier."""
-        return self.display_name or f"Anonymous-{self.user_id[:8]}"
+        return self._name
 
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class ChatRoom:
     """Represents an active chat room between two users."""
 
-    room_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    room_id: str = field(default_factory=generate_id)
     user1: User = field(default_factory=User)
     user2: User = field(default_factory=User)
     created_at: datetime = field(default_factory=datetime.now)
     active: bool = True
+    # Long-polling waiters, resolved with the next message for each user
+    user1_mailbox: Optional[asyncio.Future[Dict[str, Any]]] = field(
+        default=None, repr=False
+    )
+    user2_mailbox: Optional[asyncio.Future[Dict[str, Any]]] = field(
+        default=None, repr=False
+    )
+    # Messages that arrived after a user's waiter was already resolved,
+    # handed out on that user's next wait; created on first use
+    user1_pending: Optional[Deque[Dict[str, Any]]] = field(default=None, repr=False)
+    user2_pending: Optional[Deque[Dict[str, Any]]] = field(default=None, repr=False)
 
     def get_partner(self, user_id: str) -> Optional[User]:
         """Get the chat partner for a given user ID."""
@@ -43,13 +68,51 @@ class ChatRoom:
         """Check if a user is in this room."""
         return user_id in (self.user1.user_id, self.user2.user_id)
 
+    def get_mailbox(self, user_id: str) -> Optional[asyncio.Future[Dict[str, Any]]]:
+        """Get the waiter a user is currently blocked on, if any."""
+        if self.user1.user_id == user_id:
+            return self.user1_mailbox
+        elif self.user2.user_id == user_id:
+            return self.user2_mailbox
+        return None
+
+    def set_mailbox(
+        self, user_id: str, mailbox: Optional[asyncio.Future[Dict[str, Any]]]
+    ) -> None:
+        """Register (or clear, with None) the waiter for a user."""
+        if self.user1.user_id == user_id:
+            self.user1_mailbox = mailbox
+        elif self.user2.user_id == user_id:
+            self.user2_mailbox = mailbox
 
-@dataclass
+    def get_pending(self, user_id: str) -> Optional[Deque[Dict[str, Any]]]:
+        """Get the messages buffered for a user's next wait."""
+        if self.user1.user_id == user_id:
+            return self.user1_pending
+        elif self.user2.user_id == user_id:
+            return self.user2_pending
+        return None
+
+    def set_pending(
+        self, user_id: str, pending: Optional[Deque[Dict[str, Any]]]
+    ) -> None:
+        """Attach (or drop, with None) the message buffer for a user."""
+        if self.user1.user_id == user_id:
+            self.user1_pending = pending
+        elif self.user2.user_id == user_id:
+            self.user2_pending = pending
+
+
+@dataclass(slots=True, eq=False)
 class Message:
     """Represents a chat message."""
 
-    message_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    message_id: str = field(default_factory=generate_id)
     room_id: str = ""
     sender_id: str = ""
     content: str = ""
     timestamp: datetime = field(default_factory=datetime.now)
+    timestamp_iso: str = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self.timestamp_iso = self.timestamp.isoformat()
@@ -1,14 +1,14 @@
 """MCP Chat Server implementation."""
 
+from collections import deque
 from typing import Dict, Any
 import asyncio
 import logging
-import uuid
 from datetime import datetime
 
 from fastmcp import FastMCP
 
-from mcp_chat.models import User, Message
+from mcp_chat.models import User, ChatRoom, Message, generate_id
 from mcp_chat.managers import RoomManager
 
 # Set up logging
@@ -20,15 +20,19 @@ logger = logging.getLogger(__name__)
 # Initialize FastMCP server with SSE transport
 mcp: Any = FastMCP(name="mcp-chat", version="0.1.0")
 
+# Whether send_notification pushes over SSE; until then it only logs, so
+# per-message notifications are skipped since long-polling already delivers
+SSE_TRANSPORT_ENABLED = False
+
+# Maximum number of undelivered messages kept per user
+MAX_PENDING_MESSAGES = 100
+
 # Initialize managers
 room_manager = RoomManager()
 
 # Store active connections (connection_id -> User)
 connections: Dict[str, User] = {}
 
-# Message queues for long-polling (room_id -> {user_id -> Queue})
-message_queues: Dict[str, Dict[str, asyncio.Queue[Dict[str, Any]]]] = {}
-
 
 @mcp.tool()
 async def join_room(room_id: str, display_name: str) -> Dict[str, Any]:
@@ -51,85 +55,56 @@ async def join_room(room_id: str, display_name: str) -> Dict[str, Any]:
         Success status with client_id or error information
     """
     # Generate a unique client_id for this user
-    connection_id = str(uuid.uuid4())
+    connection_id = generate_id()
 
     # Create new user
     user = User(display_name=display_name, connection_id=connection_id)
     connections[connection_id] = user
 
     # Check if room exists
-    room = await room_manager.get_room(room_id)
+    room = room_manager.get_room(room_id)
     if not room:
         # Create a new room with just this user
-        room = await room_manager.create_room(user, user)  # Temporarily both users
-        room.room_id = room_id  # Override the generated ID
-        # Update the room in manager
-        room_manager._rooms[room_id] = room
-        room_manager._user_to_room[user.user_id] = room_id
-
-        logger.info(f"Created new room {room_id} for {user.name}")
+        created = await room_manager.register_single_user_room(room_id, user)
+        if created:
+            logger.info(f"Created new room {room_id} for {user.name}")
+
+            return {
+                "status": "room_created",
+                "room_id": room_id,
+                "client_id": connection_id,
+                "message": "New room created, waiting for another user to join",
+            }
 
-        return {
-            "status": "room_created",
-            "room_id": room_id,
-            "client_id": connection_id,
-            "message": "New room created, waiting for another user to join",
-        }
+        # Another user created the room first; join theirs instead
+        room = room_manager.get_room(room_id)
 
-    # Check if room is active
-    if not room.active:
+    # Only a recently closed room can still be missing here
+    if not room:
         return {
             "status": "error",
             "error": "Room is no longer active",
             "client_id": connection_id,
         }
 
-    # Check if room has space (max 2 users)
-    current_users = []
-    active_user_ids = {u.user_id for u in connections.values()}
-    if room.user1 and room.user1.user_id in active_user_ids:
-        current_users.append(room.user1)
-    if (
-        room.user2
-        and room.user2.user_id != room.user1.user_id
-        and room.user2.user_id in active_user_ids
-    ):
-        current_users.append(room.user2)
-
-    if len(current_users) >= 2:
+    # Add user to room (max 2 users)
+    if not await room_manager.add_second_user(room_id, user):
         return {"status": "error", "error": "Room is full", "client_id": connection_id}
 
-    # Add user to room
-    if len(current_users) == 0:
-        # First user in existing room
-        room.user1 = user
-    else:
-        # Second user joining
-        room.user2 = user
-        # Notify the first user
-        first_user = room.user1
-        if first_user and first_user.user_id in connections:
-            # Send notification about new user joining
-            if (
-                room_id in message_queues
-                and first_user.user_id in message_queues[room_id]
-            ):
-                join_msg = {
-                    "content": f"[System] {user.name} has joined the chat.",
-                    "sender_name": "System",
-                    "sender_id": "system",
-                    "timestamp": datetime.now().isoformat(),
-                    "message_id": str(uuid.uuid4()),
-                    "system": True,
-                }
-                try:
-                    message_queues[room_id][first_user.user_id].put_nowait(join_msg)
-                except (asyncio.QueueFull, RuntimeError) as e:
-                    # Queue might be full or closed
-                    logger.debug(f"Could not send join notification: {e}")
-
-    # Update user-to-room mapping
-    room_manager._user_to_room[user.user_id] = room_id
+    # Notify the first user
+    first_user = room.user1
+    if first_user and first_user.connection_id in connections:
+        # Send notification about new user joining
+        if room.get_mailbox(first_user.user_id) is not None:
+            join_msg = {
+                "content": f"[System] {user.name} has joined the chat.",
+                "sender_name": "System",
+                "sender_id": "system",
+                "timestamp": datetime.now().isoformat(),
+                "message_id": generate_id(),
+                "system": True,
+            }
+            deliver_message(room, first_user.user_id, join_msg)
 
     logger.info(f"User {user.name} joined room {room_id}")
 
@@ -173,20 +148,20 @@ async def send_message(room_id: str, message: str, client_id: str) -> Dict[str,
     user = connections.get(connection_id)
     if not user:
         logger.error(f"User not found for client_id: {client_id}")
-        logger.debug(f"Active connections: {list(connections.keys())}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Active connections: {list(connections.keys())}")
         return {
             "success": False,
             "error": f"User not found. Invalid client_id: {client_id}",
         }
 
     # Get room
-    room = await room_manager.get_room(room_id)
+    room = room_manager.get_room(room_id)
     if not room:
+        if room_manager.get_closed_room_users(room_id) is not None:
+            return {"success": False, "error": "Chat has ended"}
         return {"success": False, "error": "Room not found"}
 
-    if not room.active:
-        return {"success": False, "error": "Chat has ended"}
-
     # Verify user is in the room
     if not room.has_user(user.user_id):
         return {"success": False, "error": "You are not in this room"}
@@ -207,52 +182,33 @@ async def send_message(room_id: str, message: str, client_id: str) -> Dict[str,
         "content": message,
         "sender_name": user.name,
         "sender_id": user.user_id,
-        "timestamp": msg.timestamp.isoformat(),
+        "timestamp": msg.timestamp_iso,
         "message_id": msg.message_id,
     }
 
-    # Deliver to waiting recipients via message queues
-    if room_id in message_queues:
-        # Create a copy of items to avoid modification during iteration
-        recipients = list(message_queues[room_id].items())
-        for recipient_id, queue in recipients:
-            if recipient_id != user.user_id:  # Don't send to self
-                try:
-                    # Put message in queue (non-blocking)
-                    queue.put_nowait(message_data)
-                    logger.info(
-                        f"Delivered message to waiting queue for {recipient_id}"
-                    )
-                except asyncio.QueueFull:
-                    logger.warning(f"Queue full for recipient {recipient_id}")
-                except Exception as e:
-                    # Handle case where queue was closed/cancelled
-                    logger.warning(f"Failed to deliver to {recipient_id}: {e}")
-                    # Clean up the dead queue
-                    if (
-                        room_id in message_queues
-                        and recipient_id in message_queues[room_id]
-                    ):
-                        del message_queues[room_id][recipient_id]
-                        if not message_queues[room_id]:
-                            del message_queues[room_id]
-
-    # Still send notification for future notification support
-    await send_notification(
-        partner.connection_id,
-        "message.received",
-        {
-            "room_id": room_id,
-            "message": message,
-            "sender": {"user_id": user.user_id, "display_name": user.name},
-            "timestamp": msg.timestamp.isoformat(),
-        },
-    )
+    # Deliver to the partner if they are waiting
+    recipient_id = partner.user_id
+    if recipient_id != user.user_id:  # Don't send to self
+        if deliver_message(room, recipient_id, message_data):
+            logger.info(f"Delivered message to waiter for {recipient_id}")
+
+    # Also push a notification once the SSE transport can deliver it
+    if SSE_TRANSPORT_ENABLED:
+        await send_notification(
+            partner.connection_id,
+            "message.received",
+            {
+                "room_id": room_id,
+                "message": message,
+                "sender": {"user_id": user.user_id, "display_name": user.name},
+                "timestamp": msg.timestamp_iso,
+            },
+        )
 
     return {
         "success": True,
         "message_id": msg.message_id,
-        "timestamp": msg.timestamp.isoformat(),
+        "timestamp": msg.timestamp_iso,
     }
 
 
@@ -276,9 +232,15 @@ async def leave_chat(room_id: str, client_id: str) -> Dict[str, Any]:
         return {"success": False, "error": "User not found"}
 
     # Get room
-    room = await room_manager.get_room(room_id)
+    room = room_manager.get_room(room_id)
     if not room:
-        return {"success": False, "error": "Room not found"}
+        closed_users = room_manager.get_closed_room_users(room_id)
+        if closed_users is None:
+            return {"success": False, "error": "Room not found"}
+        if user.user_id not in closed_users:
+            return {"success": False, "error": "You are not in this room"}
+        # The partner already left and closed the room
+        return {"success": True, "message": "Successfully left the chat"}
 
     # Verify user is in the room
     if not room.has_user(user.user_id):
@@ -296,21 +258,17 @@ async def leave_chat(room_id: str, client_id: str) -> Dict[str, Any]:
     # Notify partner if they exist
     if partner:
         # Send disconnection message to waiting queue
-        if room_id in message_queues and partner.user_id in message_queues[room_id]:
+        if room.get_mailbox(partner.user_id) is not None:
             disconnect_msg = {
                 "content": "[System] Your chat partner has left the conversation.",
                 "sender_name": "System",
                 "sender_id": "system",
                 "timestamp": datetime.now().isoformat(),
-                "message_id": str(uuid.uuid4()),
+                "message_id": generate_id(),
                 "system": True,
                 "disconnect": True,
             }
-            try:
-                message_queues[room_id][partner.user_id].put_nowait(disconnect_msg)
-            except (asyncio.QueueFull, RuntimeError) as e:
-                # Queue might be full or closed
-                logger.debug(f"Could not send disconnect notification: {e}")
+            deliver_message(room, partner.user_id, disconnect_msg)
 
         # Also send regular notification
         await send_notification(
@@ -358,28 +316,30 @@ async def wait_for_message(
     user = connections.get(connection_id)
     if not user:
         logger.error(f"User not found for client_id: {client_id}")
-        logger.debug(f"Active connections: {list(connections.keys())}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Active connections: {list(connections.keys())}")
         return {"error": f"User not found. Invalid client_id: {client_id}"}
 
     # Get and validate room
-    room = await room_manager.get_room(room_id)
+    room = room_manager.get_room(room_id)
     if not room:
+        if room_manager.get_closed_room_users(room_id) is not None:
+            return {"error": "Chat has ended"}
         return {"error": "Room not found"}
 
-    if not room.active:
-        return {"error": "Chat has ended"}
-
     # Verify user is in the room
     if not room.has_user(user.user_id):
         return {"error": "You are not in this room"}
 
-    # Create a message queue for this user if not exists
-    if room_id not in message_queues:
-        message_queues[room_id] = {}
-
-    # Create queue with reasonable size limit
-    message_queue: asyncio.Queue[Dict[str, Any]] = asyncio.Queue(maxsize=100)
-    message_queues[room_id][user.user_id] = message_queue
+    # Register a waiter for this user, resolved by the next delivered message
+    waiter: asyncio.Future[Dict[str, Any]] = asyncio.get_running_loop().create_future()
+    pending = room.get_pending(user.user_id)
+    if pending:
+        # A message arrived after the previous wait returned; hand it out now
+        waiter.set_result(pending.popleft())
+        if not pending:
+            room.set_pending(user.user_id, None)
+    room.set_mailbox(user.user_id, waiter)
 
     logger.info(
         f"User {user.name} waiting for messages in room {room_id} (timeout: {timeout}s)"
@@ -387,9 +347,7 @@ async def wait_for_message(
 
     try:
         # Wait for a message with timeout
-        message_data = await asyncio.wait_for(
-            message_queue.get(), timeout=float(timeout)
-        )
+        message_data = await asyncio.wait_for(waiter, timeout=float(timeout))
 
         logger.info(
             f"Message received for {user.name}: {message_data.get('content', '')[:50]}..."
@@ -417,13 +375,42 @@ async def wait_for_message(
         return {"error": f"Unexpected error: {str(e)}"}
 
     finally:
-        # Clean up queue registration
-        if room_id in message_queues and user.user_id in message_queues[room_id]:
-            del message_queues[room_id][user.user_id]
-            # Clean up empty room entries
-            if not message_queues[room_id]:
-                del message_queues[room_id]
-            logger.info(f"Cleaned up message queue for {user.name}")
+        # Clean up waiter registration, unless a newer wait replaced it
+        if room.get_mailbox(user.user_id) is waiter:
+            room.set_mailbox(user.user_id, None)
+            logger.info(f"Cleaned up message waiter for {user.name}")
+
+
+def deliver_message(room: ChatRoom, user_id: str, message_data: Dict[str, Any]) -> bool:
+    """Hand a message to a user blocked in wait_for_message.
+
+    If the user's waiter has already been resolved but not yet returned,
+    the message is kept for their next wait instead of being dropped.
+
+    Returns:
+        True if the message resolved a waiter, False if it was buffered
+        or the user is not waiting
+    """
+    waiter = room.get_mailbox(user_id)
+    if waiter is None:
+        return False
+
+    if waiter.done():
+        if not room.active:
+            # Nobody can wait in a closed room again, so don't buffer
+            return False
+        pending = room.get_pending(user_id)
+        if pending is None:
+            pending = deque(maxlen=MAX_PENDING_MESSAGES)
+            room.set_pending(user_id, pending)
+        elif len(pending) == pending.maxlen:
+            logger.warning(f"Pending buffer full for {user_id}, dropping oldest")
+        pending.append(message_data)
+        logger.info(f"Buffered message for {user_id} until their next wait")
+        return False
+
+    waiter.set_result(message_data)
+    return True
 
 
 async def send_notification(